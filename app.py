@@ -1,14 +1,19 @@
 ﻿# AqrayPath FastAPI backend (watsonx + strong guardrails + clear reasons)
 # Endpoints:
 #   GET  /health
-#   POST /recommend {start, destination, night_test?, max_detour_min?}
+#   POST /recommend {start, destination, night_test?, max_detour_min?, include_samples?, debug?}
+# Run (prod): uvicorn app:app --loop uvloop --http httptools --workers 4
 
-import json, os, time
+import asyncio, hashlib, logging, os, re, time
+from contextlib import asynccontextmanager
 from typing import Dict, Any, List
-import requests
-from fastapi import FastAPI, HTTPException
+import httpx
+import orjson
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, conint, constr
 from urllib.parse import urlencode
 from dotenv import load_dotenv
 
@@ -22,11 +27,125 @@ DEPLOYMENT_URL = os.getenv(
 )
 GOOGLE_KEY = os.getenv("GOOGLE_MAPS_API_KEY", "")
 DALLAS_APP_TOKEN = os.getenv("SOCRATA_APP_TOKEN", "")
+REDIS_URL = os.getenv("REDIS_URL", "")  # optional shared cache across workers
+# "probes": 250 m circles at 3 points per leg (what the decision thresholds are tuned for)
+# "bbox":   one within_box aggregate per route + capped raw incidents for the heatmap
+CRIME_SUMMARY_MODE = os.getenv("CRIME_SUMMARY_MODE", "probes")
 
-REQUEST_TIMEOUT = (10, 30)  # (connect, read) seconds
+# Child of uvicorn's configured logger, so INFO records reach its handler under default logging
+log = logging.getLogger("uvicorn.error").getChild("aqraypath")
+
+REQUEST_TIMEOUT = httpx.Timeout(10.0, read=30.0)  # connect/write/pool 10s, read 30s
+
+# One async keep-alive pool for every outbound call (IAM, watsonx, Google, Open-Meteo, Socrata)
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=REQUEST_TIMEOUT,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            retries=2,  # connect-level retries
+        ),
+    )
+
+CLIENT = _new_client()
+
+# Per-process TTL caches for slow-changing lookups
+_CRIME_CACHE = TTLCache(maxsize=4096, ttl=900)    # (lat, lon, radius, days) -> count
+_GEO_CACHE = TTLCache(maxsize=2048, ttl=86400)    # lowercased place name -> {lat, lon}
+_WX_CACHE = TTLCache(maxsize=1024, ttl=600)       # (lat, lon) @ ~1 km -> current weather
+_AGENT_CACHE = TTLCache(maxsize=2048, ttl=1800)   # prompt feature hash -> normalized agent output
+_MISS = object()
+stats = {"hits": 0, "misses": 0, "shared_hits": 0}
+agent_stats = {"hits": 0, "misses": 0, "shared_hits": 0}
+decision_stats = {"ask_user": 0, "continue": 0}
+
+def cache_get(cache: TTLCache, key, counters: Dict[str, int] = stats):
+    val = cache.get(key, _MISS)
+    counters["misses" if val is _MISS else "hits"] += 1
+    return val
+
+# Shared L2 cache (JSON values with TTL) so workers/restarts reuse each other's lookups
+class RedisCacheBackend:
+    def __init__(self, url: str, prefix: str = "aqraypath:"):
+        import redis.asyncio as aioredis
+        self._redis = aioredis.from_url(url)
+        self._prefix = prefix
+
+    async def get(self, key: str):
+        try:
+            raw = await self._redis.get(self._prefix + key)
+        except Exception as e:
+            log.warning("redis get failed: %s", e)
+            return None
+        return None if raw is None else orjson.loads(raw)
+
+    async def set(self, key: str, value, ttl: int) -> None:
+        try:
+            await self._redis.set(self._prefix + key, orjson.dumps(value), ex=ttl)
+        except Exception as e:
+            log.warning("redis set failed: %s", e)
+
+    async def delete(self, key: str) -> None:
+        await self._redis.delete(self._prefix + key)
+
+    async def clear(self) -> None:
+        async for k in self._redis.scan_iter(match=self._prefix + "*"):
+            await self._redis.delete(k)
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+SHARED_CACHE = RedisCacheBackend(REDIS_URL) if REDIS_URL else None
+
+def _shared_key(ns: str, key) -> str:
+    return f"{ns}:" + (",".join(map(str, key)) if isinstance(key, tuple) else str(key))
+
+# Local TTLCache, then the shared Redis cache (if configured); _MISS means go to the network
+async def tiered_get(cache: TTLCache, ns: str, key, counters: Dict[str, int] = stats):
+    val = cache_get(cache, key, counters)
+    if val is _MISS and SHARED_CACHE is not None:
+        shared = await SHARED_CACHE.get(_shared_key(ns, key))
+        if shared is not None:
+            counters["shared_hits"] += 1
+            cache[key] = val = shared
+    return val
+
+async def tiered_set(cache: TTLCache, ns: str, key, value) -> None:
+    cache[key] = value
+    if SHARED_CACHE is not None:
+        await SHARED_CACHE.set(_shared_key(ns, key), value, int(cache.ttl))
+
+# Single-flight: concurrent identical lookups share one in-flight task
+_inflight: Dict[str, asyncio.Future] = {}
+
+async def single_flight(key: str, coro_factory):
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(coro_factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield so one cancelled waiter doesn't cancel the shared call
+    return await asyncio.shield(task)
 
 # ---------- App ----------
-app = FastAPI(title="AqrayPath Wrapper", version="1.5.0")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global CLIENT, SHARED_CACHE
+    # a previous lifespan in this process (tests, embedding) may have closed them
+    if CLIENT.is_closed:
+        CLIENT = _new_client()
+    if REDIS_URL and SHARED_CACHE is None:
+        SHARED_CACHE = RedisCacheBackend(REDIS_URL)
+    try:
+        yield
+    finally:
+        await CLIENT.aclose()
+        if SHARED_CACHE is not None:
+            await SHARED_CACHE.close()
+            SHARED_CACHE = None
+
+app = FastAPI(title="AqrayPath Wrapper", version="1.5.0", lifespan=lifespan)
 
 # CORS for Streamlit / localhost
 app.add_middleware(
@@ -36,27 +155,55 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# /recommend bodies carry polylines + debug probes; compress anything non-trivial
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+Place = constr(strip_whitespace=True, min_length=2, max_length=200)
 
 class RouteRequest(BaseModel):
-    start: str
-    destination: str
-    night_test: bool | None = None      # demo toggle to force night behavior
-    max_detour_min: int | None = None   # user-tunable detour cap (defaults to 6)
+    start: Place
+    destination: Place
+    night_test: bool | None = None                     # demo toggle to force night behavior
+    max_detour_min: conint(ge=0, le=60) | None = None  # user-tunable detour cap (defaults to 6)
+    include_samples: bool | None = False               # include route crime samples (heatmap) in the response
+    debug: bool | None = False                         # include samples + the agent prompt in the response
 
 # ---------- IBM helpers ----------
-def get_iam_token(api_key: str) -> str:
+# IAM tokens live ~1h; reuse one until shortly before expiry
+_token_cache = {"token": None, "exp": 0.0, "retry_at": 0.0}
+IAM_RETRY_AFTER_S = 15.0  # after a failed refresh, fail fast instead of re-hitting IAM
+
+async def get_iam_token_cached(api_key: str) -> str:
+    if time.time() < _token_cache["exp"] - 60:
+        return _token_cache["token"]
+    if time.time() < _token_cache["retry_at"]:
+        raise HTTPException(status_code=503, detail="IAM token refresh failed recently.")
+    # one refresh in flight; concurrent callers share its token or its failure
+    return await single_flight("iam", lambda: _refresh_iam_token(api_key))
+
+async def _refresh_iam_token(api_key: str) -> str:
+    try:
+        j = await get_iam_token(api_key)
+    except Exception:
+        _token_cache["retry_at"] = time.time() + IAM_RETRY_AFTER_S
+        raise
+    _token_cache["token"] = j["access_token"]
+    _token_cache["exp"] = time.time() + float(j.get("expires_in", 3600))
+    _token_cache["retry_at"] = 0.0
+    return _token_cache["token"]
+
+async def get_iam_token(api_key: str) -> Dict[str, Any]:
     if not api_key:
         raise HTTPException(status_code=500, detail="Missing IBM_CLOUD_API_KEY.")
-    resp = requests.post(
+    resp = await CLIENT.post(
         "https://iam.cloud.ibm.com/identity/token",
         headers={"Content-Type": "application/x-www-form-urlencoded"},
-        data=f"grant_type=urn:ibm:params:oauth:grant-type:apikey&apikey={api_key}",
-        timeout=REQUEST_TIMEOUT,
+        content=f"grant_type=urn:ibm:params:oauth:grant-type:apikey&apikey={api_key}",
     )
     resp.raise_for_status()
-    return resp.json()["access_token"]
+    return orjson.loads(resp.content)
 
-def call_watsonx(token: str, prompt_text: str) -> Dict[str, Any]:
+async def call_watsonx(token: str, prompt_text: str) -> Dict[str, Any]:
     payload = {
         "messages": [
             {
@@ -78,19 +225,18 @@ def call_watsonx(token: str, prompt_text: str) -> Dict[str, Any]:
             {"role": "user", "content": prompt_text},
         ]
     }
-    resp = requests.post(
+    resp = await CLIENT.post(
         DEPLOYMENT_URL,
-        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-        data=json.dumps(payload),
-        timeout=REQUEST_TIMEOUT,
+        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json", "Accept-Encoding": "gzip"},
+        content=orjson.dumps(payload),
     )
     resp.raise_for_status()
-    return resp.json()
+    return orjson.loads(resp.content)
 
 def parse_agent_content(resp_json: Dict[str, Any]) -> Dict[str, Any]:
     content = resp_json.get("choices", [{}])[0].get("message", {}).get("content", "")
     try:
-        return json.loads(content)
+        return orjson.loads(content)
     except Exception:
         return {"raw": content}
 
@@ -114,7 +260,10 @@ def normalize_agent(parsed: Dict[str, Any], eta_change_min: int) -> Dict[str, An
     return out
 
 # ---------- Google helpers ----------
-def gmaps_directions(origin: str, dest: str) -> Dict[str, Any]:
+async def gmaps_directions(origin: str, dest: str) -> Dict[str, Any]:
+    return await single_flight(f"gmaps:{origin}|{dest}", lambda: _fetch_directions(origin, dest))
+
+async def _fetch_directions(origin: str, dest: str) -> Dict[str, Any]:
     if not GOOGLE_KEY:
         raise HTTPException(status_code=500, detail="GOOGLE_MAPS_API_KEY not set.")
     params = {
@@ -124,23 +273,23 @@ def gmaps_directions(origin: str, dest: str) -> Dict[str, Any]:
         "alternatives": "true",
         "key": GOOGLE_KEY,
     }
-    r = requests.get("https://maps.googleapis.com/maps/api/directions/json", params=params, timeout=REQUEST_TIMEOUT)
+    r = await CLIENT.get("https://maps.googleapis.com/maps/api/directions/json", params=params)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     if data.get("status") != "OK":
         raise HTTPException(status_code=400, detail=f"Google Directions error: {data.get('status')}")
     return data
 
+_HTML_CLEAN = re.compile(r'</?b>|<div style="font-size:0\.9em">|</div>')
+
 def steps_to_streets(steps: List[Dict[str, Any]]) -> List[str]:
     streets = []
     for s in steps:
         name = s.get("maneuver") or ""
         if not name:
-            instr = s.get("html_instructions", "")
-            name = (instr
-                    .replace("<b>", "").replace("</b>", "")
-                    .replace('<div style="font-size:0.9em">', " ")
-                    .replace("</div>", " "))
+            name = _HTML_CLEAN.sub(" ", s.get("html_instructions", ""))
+        if not name:
+            continue
         name = " ".join(name.split())
         if name:
             streets.append(name)
@@ -150,126 +299,284 @@ def steps_to_streets(steps: List[Dict[str, Any]]) -> List[str]:
 
 def pick_routes(routes: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
     fastest = min(routes, key=lambda r: r["legs"][0]["duration"]["value"])
+    lights = {id(r): lighting_score_from_steps(r["legs"][0]["steps"]) for r in routes}
     def light_score(r):
-        steps = r["legs"][0]["steps"]
-        text = " ".join([s.get("html_instructions","") for s in steps]).lower()
-        score = sum(kw in text for kw in ["blvd", "ave", "main", "park", "downtown", "plaza", "square"])
-        return (score, -r["legs"][0]["duration"]["value"])
+        return (lights[id(r)], -r["legs"][0]["duration"]["value"])
     alts = [r for r in routes if r is not fastest]
     candidate = max(alts, key=light_score) if alts else fastest
-    return {"current": fastest, "candidate": candidate}
+    return {
+        "current": fastest,
+        "candidate": candidate,
+        "light": {"current": lights[id(fastest)], "candidate": lights[id(candidate)]},
+    }
 
 # ---------- Weather (Open-Meteo) ----------
-def geocode_city(name: str) -> Dict[str, float]:
-    g = requests.get(
+async def geocode_city(name: str) -> Dict[str, float]:
+    key = name.strip().lower()
+    hit = await tiered_get(_GEO_CACHE, "geo", key)
+    if hit is not _MISS:
+        return hit
+    return await single_flight(f"geo:{key}", lambda: _fetch_geocode(name, key))
+
+async def _fetch_geocode(name: str, key: str) -> Dict[str, float]:
+    g = await CLIENT.get(
         "https://geocoding-api.open-meteo.com/v1/search",
         params={"name": name, "count": 1, "language": "en", "format": "json"},
-        timeout=REQUEST_TIMEOUT,
     )
     g.raise_for_status()
-    j = g.json()
+    j = orjson.loads(g.content)
     if not j.get("results"):
         # fallback to Dallas center
-        return {"lat": 32.7767, "lon": -96.7970}
-    r = j["results"][0]
-    return {"lat": r["latitude"], "lon": r["longitude"]}
-
-def get_current_weather(lat: float, lon: float) -> Dict[str, Any]:
-    w = requests.get(
+        geo = {"lat": 32.7767, "lon": -96.7970}
+    else:
+        r = j["results"][0]
+        geo = {"lat": r["latitude"], "lon": r["longitude"]}
+    await tiered_set(_GEO_CACHE, "geo", key, geo)
+    return geo
+
+async def get_current_weather(lat: float, lon: float) -> Dict[str, Any]:
+    key = (round(lat, 2), round(lon, 2))
+    hit = await tiered_get(_WX_CACHE, "wx", key)
+    if hit is not _MISS:
+        return hit
+    w = await CLIENT.get(
         "https://api.open-meteo.com/v1/forecast",
         params={"latitude": lat, "longitude": lon, "current": "temperature_2m,precipitation,weather_code,wind_speed_10m"},
-        timeout=REQUEST_TIMEOUT,
     )
     w.raise_for_status()
-    return w.json().get("current", {})
+    cur = orjson.loads(w.content).get("current", {})
+    await tiered_set(_WX_CACHE, "wx", key, cur)
+    return cur
+
+_WX_MAP = {
+    0: "Clear", 1: "Mainly clear", 2: "Partly cloudy", 3: "Overcast",
+    45: "Fog", 48: "Depositing rime fog",
+    51: "Light drizzle", 53: "Drizzle", 55: "Dense drizzle",
+    61: "Light rain", 63: "Rain", 65: "Heavy rain",
+    71: "Light snow", 73: "Snow", 75: "Heavy snow",
+    80: "Rain showers", 81: "Moderate rain showers", 82: "Violent rain showers",
+    95: "Thunderstorm", 96: "Thunderstorm with slight hail", 99: "Thunderstorm with heavy hail",
+}
+
+# Rain, showers, storms and fog
+_BAD_WX = frozenset({61, 63, 65, 80, 81, 82, 95, 96, 99, 45, 48})
 
 def wx_code_to_text(code: int) -> str:
-    mapping = {
-        0: "Clear", 1: "Mainly clear", 2: "Partly cloudy", 3: "Overcast",
-        45: "Fog", 48: "Depositing rime fog",
-        51: "Light drizzle", 53: "Drizzle", 55: "Dense drizzle",
-        61: "Light rain", 63: "Rain", 65: "Heavy rain",
-        71: "Light snow", 73: "Snow", 75: "Heavy snow",
-        80: "Rain showers", 81: "Moderate rain showers", 82: "Violent rain showers",
-        95: "Thunderstorm", 96: "Thunderstorm with slight hail", 99: "Thunderstorm with heavy hail",
-    }
-    return mapping.get(code, f"Code {code}")
+    return _WX_MAP.get(code, f"Code {code}")
 
 # ---------- Crime (Dallas Open Data) ----------
-def crime_count(lat: float, lon: float, radius_m: int = 500, days: int = 30) -> int:
-    endpoint = "https://www.dallasopendata.com/resource/yn72-daik.json"
-    since = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - days * 86400))
-    where = f"upzdate > '{since}' AND within_circle(geocoded_column,{lat},{lon},{radius_m})"
-    qs = urlencode({"$select": "count(1)", "$where": where})
+CRIME_ENDPOINT = "https://www.dallasopendata.com/resource/yn72-daik.json"
+PROBE_DECIMALS = 3  # ~110 m grid — well inside the 250 m probe radius, so neighbours share one query
+
+def _crime_key(lat: float, lon: float, radius_m: int, days: int) -> tuple:
+    return (round(lat, PROBE_DECIMALS), round(lon, PROBE_DECIMALS), radius_m, days)
+
+def _crime_since(days: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - days * 86400))
+
+async def _socrata_query(params: Dict[str, str]) -> List[Dict[str, Any]]:
     headers = {"X-App-Token": DALLAS_APP_TOKEN} if DALLAS_APP_TOKEN else {}
-    r = requests.get(f"{endpoint}?{qs}", headers=headers, timeout=REQUEST_TIMEOUT)
+    r = await CLIENT.get(f"{CRIME_ENDPOINT}?{urlencode(params)}", headers=headers)
     r.raise_for_status()
-    j = r.json()
+    return orjson.loads(r.content)
+
+async def crime_count(lat: float, lon: float, radius_m: int = 500, days: int = 30) -> int:
+    key = _crime_key(lat, lon, radius_m, days)
+    hit = await tiered_get(_CRIME_CACHE, "crime", key)
+    if hit is not _MISS:
+        return hit
+    return await _crime_count_miss(lat, lon, radius_m, days, key)
+
+# Network fetch for a key already known to be uncached (writes the cache itself)
+async def _crime_count_miss(lat: float, lon: float, radius_m: int, days: int, key: tuple) -> int:
+    return await single_flight(
+        "crime:{},{},{},{}".format(*key),
+        lambda: _fetch_crime_count(lat, lon, radius_m, days, key),
+    )
+
+async def _fetch_crime_count(lat: float, lon: float, radius_m: int, days: int, key: tuple) -> int:
+    where = f"upzdate > '{_crime_since(days)}' AND within_circle(geocoded_column,{lat},{lon},{radius_m})"
+    j = await _socrata_query({"$select": "count(1)", "$where": where})
+    try:
+        cnt = int(j[0].get("count_1", 0))
+    except Exception:
+        cnt = 0
+    await tiered_set(_CRIME_CACHE, "crime", key, cnt)
+    return cnt
+
+# Per-point counts for many circles in one SoQL call (one sum(case(...)) column per point)
+async def crime_counts(points: List[tuple], radius_m: int = 250, days: int = 30) -> List[int]:
+    keys = [_crime_key(lat, lon, radius_m, days) for lat, lon in points]
+    # points in the same ~110 m cell share one lookup/fetch, but each still gets its count
+    cells: Dict[tuple, tuple] = {}
+    for k, pt in zip(keys, points):
+        cells.setdefault(k, pt)
+    found = dict(zip(cells, await asyncio.gather(*[tiered_get(_CRIME_CACHE, "crime", k) for k in cells])))
+    todo = [k for k, v in found.items() if v is _MISS]
+    if len(todo) <= 1:
+        for k in todo:
+            found[k] = await _crime_count_miss(*cells[k], radius_m, days, k)
+        return [found[k] for k in keys]
+    todo.sort()
+    # concurrent identical requests share one batched query
+    batch_key = "crime_batch:" + "|".join("{},{},{},{}".format(*k) for k in todo)
+    fetched = await single_flight(batch_key, lambda: _fetch_crime_batch([cells[k] for k in todo], todo, radius_m, days))
+    found.update(zip(todo, fetched))
+    return [found[k] for k in keys]
+
+async def _fetch_crime_batch(points: List[tuple], keys: List[tuple], radius_m: int, days: int) -> List[int]:
+    circles = [f"within_circle(geocoded_column,{lat},{lon},{radius_m})" for lat, lon in points]
+    select = ", ".join(f"sum(case({c},1,true,0)) as c{n}" for n, c in enumerate(circles))
+    where = f"upzdate > '{_crime_since(days)}' AND (" + " OR ".join(circles) + ")"
     try:
-        return int(j[0].get("count_1", 0))
+        row = (await _socrata_query({"$select": select, "$where": where}) or [{}])[0]
     except Exception:
-        return 0
+        # batched query rejected — fall back to one concurrent call per point (each caches its result)
+        return list(await asyncio.gather(*[_crime_count_miss(*pt, radius_m, days, k) for pt, k in zip(points, keys)]))
+    fetched = []
+    for n in range(len(keys)):
+        try:
+            fetched.append(int(float(row.get(f"c{n}") or 0)))
+        except Exception:
+            fetched.append(0)
+    await asyncio.gather(*[tiered_set(_CRIME_CACHE, "crime", k, cnt) for k, cnt in zip(keys, fetched)])
+    return fetched
 
 # ---------- Route crime probes ----------
 def leg_probe_points(leg: Dict[str, Any]) -> List[Dict[str, float]]:
     steps = leg.get("steps", [])
-    if not steps:
-        return []
     n = len(steps)
-    idxs = {0 if n == 1 else max(1, n // 3), n // 2, max(0, n - 2)}
-    coords = []
-    for idx in sorted(idxs):
-        try:
-            coords.append(steps[idx]["end_location"])
-        except Exception:
-            pass
-    # dedupe
-    seen = set(); uniq = []
-    for p in coords:
-        try:
-            key = (round(float(p.get("lat")), 6), round(float(p.get("lng")), 6))
-        except Exception:
+    if n <= 0:
+        return []
+    # all indices are in [0, n) by construction
+    idxs = sorted({0 if n == 1 else max(1, n // 3), n // 2, max(0, n - 2)})
+    keys = []
+    for idx in idxs:
+        p = steps[idx].get("end_location")
+        if not p:
             continue
-        if key in seen:
+        try:
+            keys.append((round(float(p["lat"]), 6), round(float(p["lng"]), 6)))
+        except (KeyError, TypeError, ValueError):
             continue
-        seen.add(key)
-        uniq.append({"lat": key[0], "lng": key[1]})
-    return uniq
-
-def route_crime_summary(leg: Dict[str, Any], radius_m: int = 250, days: int = 30) -> Dict[str, Any]:
-    pts = leg_probe_points(leg)
-    samples, total = [], 0
-    for p in pts:
+    # dedupe exact repeats only; nearby probes stay separate and share a cache cell via _crime_key
+    return [{"lat": lat, "lng": lng} for lat, lng in dict.fromkeys(keys)]
+
+def _probe_coords(leg: Dict[str, Any]) -> List[tuple]:
+    pts = []
+    for p in leg_probe_points(leg):
         try:
-            lat = float(p.get("lat")); lon = float(p.get("lng"))
+            pts.append((float(p.get("lat")), float(p.get("lng"))))
         except Exception:
             continue
-        cnt = crime_count(lat, lon, radius_m=radius_m, days=days)
-        samples.append({"lat": lat, "lon": lon, "count": cnt})
-        total += cnt
-    # NOTE: samples here are perfect for a weighted heatmap: [lat, lon, weight=count]
-    return {"total": total, "samples": samples, "radius_m": radius_m, "days": days}
+    return pts
+
+async def route_crime_summaries(legs: List[Dict[str, Any]], radius_m: int = 250, days: int = 30) -> List[Dict[str, Any]]:
+    per_leg = [_probe_coords(leg) for leg in legs]
+    # Routes often share probe points — count each unique point once, in a single batched query
+    all_pts = list(dict.fromkeys(pt for pts in per_leg for pt in pts))
+    counts = await crime_counts(all_pts, radius_m=radius_m, days=days)
+    by_pt = dict(zip(all_pts, counts))
+    out = []
+    for pts in per_leg:
+        # NOTE: samples here are perfect for a weighted heatmap: [lat, lon, weight=count]
+        samples = [[lat, lon, by_pt[(lat, lon)]] for lat, lon in pts]
+        total = sum(cnt for _, _, cnt in samples)
+        out.append({"total": total, "samples": samples, "radius_m": radius_m, "days": days})
+    return out
+
+# (north, west, south, east) from Google's route bounds, or None if absent
+def _route_box(route: Dict[str, Any]) -> tuple | None:
+    b = route.get("bounds") or {}
+    ne, sw = b.get("northeast") or {}, b.get("southwest") or {}
+    try:
+        return (float(ne["lat"]), float(sw["lng"]), float(sw["lat"]), float(ne["lng"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def _incident_latlon(row: Dict[str, Any]) -> tuple | None:
+    g = row.get("geocoded_column") or {}
+    try:
+        if "coordinates" in g:  # GeoJSON point: [lon, lat]
+            return (float(g["coordinates"][1]), float(g["coordinates"][0]))
+        return (float(g["latitude"]), float(g["longitude"]))
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+# One aggregate per route over its bounding box, plus one capped raw-incident query for the heatmap
+async def route_crime_boxes(routes: List[Dict[str, Any]], days: int = 30, sample_limit: int = 500) -> List[Dict[str, Any]]:
+    boxes = [_route_box(r) for r in routes]
+    if any(b is None for b in boxes):
+        return await route_crime_summaries([r["legs"][0] for r in routes], radius_m=250, days=days)
+    key = tuple(round(v, PROBE_DECIMALS) for b in boxes for v in b) + (days,)
+    hit = await tiered_get(_CRIME_CACHE, "crime_box", key)
+    if hit is not _MISS:
+        return hit
+    preds = [f"within_box(geocoded_column,{n},{w},{s},{e})" for n, w, s, e in boxes]
+    where = f"upzdate > '{_crime_since(days)}' AND (" + " OR ".join(preds) + ")"
+    select = ", ".join(f"sum(case({p},1,true,0)) as c{i}" for i, p in enumerate(preds))
+    totals, incidents = await asyncio.gather(
+        _socrata_query({"$select": select, "$where": where}),
+        _socrata_query({"$select": "geocoded_column", "$where": where, "$limit": str(sample_limit)}),
+    )
+    row = (totals or [{}])[0]
+    pts = [pt for pt in map(_incident_latlon, incidents) if pt]
+    out = []
+    for i, (n, w, s, e) in enumerate(boxes):
+        try:
+            total = int(float(row.get(f"c{i}") or 0))
+        except (TypeError, ValueError):
+            total = 0
+        samples = [[lat, lon, 1] for lat, lon in pts if s <= lat <= n and w <= lon <= e]
+        out.append({"total": total, "samples": samples, "bounds": [n, w, s, e], "days": days})
+    await tiered_set(_CRIME_CACHE, "crime_box", key, out)
+    return out
 
 # ---------- Lighting helper ----------
+_LIGHT_RE = re.compile(r"\b(blvd|ave|main|park|downtown|plaza|square)\b")
+
 def lighting_score_from_steps(steps: List[Dict[str, Any]]) -> int:
-    text = " ".join([s.get("html_instructions", "") for s in steps]).lower()
-    kws = ["blvd", "ave", "main", "park", "downtown", "plaza", "square"]
-    return sum(k in text for k in kws)
+    text = " ".join(s.get("html_instructions", "") for s in steps).lower()
+    # number of distinct lighting keywords present, found in a single scan
+    return len(set(_LIGHT_RE.findall(text)))
 
 # ---------- API ----------
 @app.get("/health")
 def health():
-    return {"ok": True}
+    return {"ok": True, "cache": stats, "agent_cache": agent_stats, "decisions": decision_stats}
+
+def _record_metrics(normalized: Dict[str, Any], scores: Dict[str, Any], prompt: str) -> None:
+    decision = normalized.get("decision", "continue")
+    decision_stats[decision] = decision_stats.get(decision, 0) + 1
+    log.info(
+        "recommend decision=%s crime=%s->%s eta=%+d night=%s prompt_chars=%d",
+        decision, scores["crime_current"], scores["crime_candidate"],
+        scores["eta_change_min"], scores["is_night"], len(prompt),
+    )
 
 @app.post("/recommend")
-def recommend(req: RouteRequest):
-    # 1) Routes
-    data = gmaps_directions(req.start, req.destination)
+async def recommend(req: RouteRequest, background: BackgroundTasks):
+    # 0) Reject trivially bad input before any outbound call
+    if req.start.lower() == req.destination.lower():
+        raise HTTPException(status_code=400, detail="start equals destination")
+
+    # 1) Routes and destination geocode are independent — fetch together. The IAM token is
+    # started alongside but only awaited if the agent is actually called (step 5).
+    token_task = asyncio.create_task(get_iam_token_cached(IBM_API_KEY))
+    token_task.add_done_callback(lambda t: t.cancelled() or t.exception())  # unawaited failures stay quiet
+    data, geo = await asyncio.gather(
+        gmaps_directions(req.start, req.destination),
+        geocode_city(req.destination),
+        return_exceptions=True,
+    )
+    if isinstance(data, BaseException):
+        raise data
     if not data.get("routes"):
         raise HTTPException(status_code=404, detail="No routes found")
     pick = pick_routes(data["routes"])
     cur = pick["current"]; can = pick["candidate"]
     cur_leg = cur["legs"][0]; can_leg = can["legs"][0]
+    cur_light = pick["light"]["current"]; can_light = pick["light"]["candidate"]
 
     # Map bits
     current_poly = cur.get("overview_polyline", {}).get("points", "")
@@ -282,20 +589,22 @@ def recommend(req: RouteRequest):
     candidate_streets = " -> ".join(steps_to_streets(can_leg["steps"]))
     eta_change_min = round((can_leg["duration"]["value"] - cur_leg["duration"]["value"]) / 60.0)
 
-    # 3) Weather
-    try:
-        geo = geocode_city(req.destination)
-    except Exception:
+    # 3) Weather + 4) Crime — all keyed off the geocode / legs, run concurrently
+    if isinstance(geo, BaseException):
         geo = {"lat": 32.7767, "lon": -96.7970}
-    cur_wx = get_current_weather(geo["lat"], geo["lon"])
-    wx_text = wx_code_to_text(int(cur_wx.get("weather_code", 0)))
+    cur_wx, crime_30d, (current_crime, candidate_crime) = await asyncio.gather(
+        get_current_weather(geo["lat"], geo["lon"]),
+        crime_count(geo["lat"], geo["lon"], radius_m=500, days=30),
+        route_crime_boxes([cur, can], days=30) if CRIME_SUMMARY_MODE == "bbox"
+        else route_crime_summaries([cur_leg, can_leg], radius_m=250, days=30),
+    )
+    weather_code = int(cur_wx.get("weather_code", 0))
+    bad_weather = weather_code in _BAD_WX
+    wx_text = wx_code_to_text(weather_code)
     precip = cur_wx.get("precipitation", 0)
     temp_c = cur_wx.get("temperature_2m", 0)
-
-    # 4) Crime
-    crime_30d = crime_count(geo["lat"], geo["lon"], radius_m=500, days=30)
-    current_crime = route_crime_summary(cur_leg, radius_m=250, days=30)
-    candidate_crime = route_crime_summary(can_leg, radius_m=250, days=30)
+    hour = int(time.strftime("%H"))
+    is_night = (hour >= 20 or hour <= 5) or bool(req.night_test)
 
     now = time.strftime("%H:%M")
     context = (
@@ -310,79 +619,98 @@ def recommend(req: RouteRequest):
         f"etaChangeMinutes = {eta_change_min}\nproposedRouteName = {proposed}"
     )
 
-    # 5) Agent decision — try Watson; fallback to heuristic
-    try:
-        token = get_iam_token(IBM_API_KEY)
-        raw = call_watsonx(token, prompt)
-        parsed = parse_agent_content(raw)
-        normalized = normalize_agent(parsed, eta_change_min)
-    except Exception:
-        # Local fallback
-        crime_margin = 10
-        eta_hard_cap = req.max_detour_min if getattr(req, "max_detour_min", None) not in (None, 0) else 6
-        small_gain_threshold = 1
-        eta_penalty = eta_change_min
-        reasons = []
-        decision = "continue"
-        deltaSafety = 0
-        msg = "Using local heuristic due to AI service error. Keeping your current route."
-
-        cand_worse = candidate_crime["total"] > current_crime["total"] + crime_margin
-        if cand_worse:
-            diff = candidate_crime["total"] - current_crime["total"]
-            reasons.append("higher route crime")
-            msg = f"Candidate has higher recent incident density (+{diff}). Keeping your current route."
-        else:
-            crime_gain = current_crime["total"] - candidate_crime["total"]
-            if crime_gain >= 15 and eta_penalty <= eta_hard_cap:
-                decision = "ask_user"
-                deltaSafety = 2
-                reasons.append("lower route crime")
-                msg = f"Candidate shows a lower recent incident density (−{crime_gain}). Reroute now or continue?"
-            hour = int(time.strftime("%H"))
-            is_night = (hour >= 20 or hour <= 5) or bool(getattr(req, "night_test", None))
-            if is_night:
-                cur_light = lighting_score_from_steps(cur_leg.get("steps", []))
-                can_light = lighting_score_from_steps(can_leg.get("steps", []))
-                if can_light > cur_light and eta_penalty <= eta_hard_cap and not cand_worse:
-                    decision = "ask_user"
-                    deltaSafety = max(deltaSafety, 1)
-                    reasons.append("better lighting at night")
-                    if not msg.endswith("Reroute now or continue?"):
-                        msg = (msg.rstrip(".") + ". Reroute now or continue?")
-            if eta_penalty >= eta_hard_cap and deltaSafety <= small_gain_threshold:
-                decision = "continue"
-                reasons.append("large ETA penalty")
-                msg = f"Detour adds ~{eta_penalty} min without a clear safety gain. Keeping your current route."
-
+    # ---------- DETERMINISTIC SAFETY RULES (before the agent) ----------
+    # Outcomes the agent could not change are decided up front, so neither the
+    # IAM token nor the watsonx call is waited on when they fire.
+    crime_margin_override = 10
+    detour_cap = req.max_detour_min if getattr(req, "max_detour_min", None) not in (None, 0) else 6
+    crime_gain = current_crime["total"] - candidate_crime["total"]
+    if candidate_crime["total"] >= current_crime["total"] + crime_margin_override:
         normalized = {
-            "deltaSafety": int(deltaSafety),
-            "decision": "ask_user" if decision == "ask_user" else "continue",
-            "message": msg if decision == "ask_user" else (msg.rstrip(".") + ". Keeping your current route."),
-            "etaChangeMinutes": int(eta_penalty),
+            "deltaSafety": 0,
+            "decision": "continue",
+            "message": f"Candidate has higher recent incident density (+{-crime_gain}). Keeping your current route.",
+            "etaChangeMinutes": int(eta_change_min),
             "proposedRouteName": proposed,
-            "reasons": sorted(set(reasons)),
+            "reasons": ["higher route crime"],
         }
-
-    # ---------- FINAL SAFETY OVERRIDE ----------
-    crime_margin_override = 10
-    if candidate_crime["total"] >= current_crime["total"] + crime_margin_override:
-        diff = candidate_crime["total"] - current_crime["total"]
-        normalized["decision"] = "continue"
-        normalized["message"] = f"Candidate has higher recent incident density (+{diff}). Keeping your current route."
-        reasons = set(normalized.get("reasons", []))
-        reasons.add("higher route crime")
-        normalized["reasons"] = sorted(reasons)
+    elif eta_change_min >= detour_cap and crime_gain <= 0:
+        normalized = {
+            "deltaSafety": 0,
+            "decision": "continue",
+            "message": f"Detour adds ~{eta_change_min} min without a clear safety gain. Keeping your current route.",
+            "etaChangeMinutes": int(eta_change_min),
+            "proposedRouteName": proposed,
+            "reasons": ["large ETA penalty"],
+        }
+    else:
+        # 5) Agent decision — cached by prompt features; else try Watson; fallback to heuristic
+        # stable across processes (shared cache), no JSON round-trip
+        cache_key = hashlib.blake2b(
+            f"{wx_text}|{round(float(temp_c or 0))}|{round(float(precip or 0), 1)}|{is_night}|"
+            f"{current_crime['total']}|{candidate_crime['total']}|{eta_change_min}|"
+            f"{current_streets}|{candidate_streets}|{proposed}".encode(),
+            digest_size=16,
+        ).hexdigest()
+        try:
+            hit = await tiered_get(_AGENT_CACHE, "agent", cache_key, agent_stats)
+            if hit is not _MISS:
+                normalized = dict(hit)
+            else:
+                raw = await call_watsonx(await token_task, prompt)
+                parsed = parse_agent_content(raw)
+                normalized = normalize_agent(parsed, eta_change_min)
+                # cache writeback happens after the response is sent
+                background.add_task(tiered_set, _AGENT_CACHE, "agent", cache_key, dict(normalized))
+        except Exception:
+            # Local fallback
+            crime_margin = 10
+            eta_hard_cap = req.max_detour_min if getattr(req, "max_detour_min", None) not in (None, 0) else 6
+            small_gain_threshold = 1
+            eta_penalty = eta_change_min
+            reasons = []
+            decision = "continue"
+            deltaSafety = 0
+            msg = "Using local heuristic due to AI service error. Keeping your current route."
+
+            cand_worse = candidate_crime["total"] > current_crime["total"] + crime_margin
+            if cand_worse:
+                diff = candidate_crime["total"] - current_crime["total"]
+                reasons.append("higher route crime")
+                msg = f"Candidate has higher recent incident density (+{diff}). Keeping your current route."
+            else:
+                crime_gain = current_crime["total"] - candidate_crime["total"]
+                if crime_gain >= 15 and eta_penalty <= eta_hard_cap:
+                    decision = "ask_user"
+                    deltaSafety = 2
+                    reasons.append("lower route crime")
+                    msg = f"Candidate shows a lower recent incident density (−{crime_gain}). Reroute now or continue?"
+                if is_night:
+                    if can_light > cur_light and eta_penalty <= eta_hard_cap and not cand_worse:
+                        decision = "ask_user"
+                        deltaSafety = max(deltaSafety, 1)
+                        reasons.append("better lighting at night")
+                        if not msg.endswith("Reroute now or continue?"):
+                            msg = (msg.rstrip(".") + ". Reroute now or continue?")
+                if eta_penalty >= eta_hard_cap and deltaSafety <= small_gain_threshold:
+                    decision = "continue"
+                    reasons.append("large ETA penalty")
+                    msg = f"Detour adds ~{eta_penalty} min without a clear safety gain. Keeping your current route."
+
+            normalized = {
+                "deltaSafety": int(deltaSafety),
+                "decision": "ask_user" if decision == "ask_user" else "continue",
+                "message": msg if decision == "ask_user" else (msg.rstrip(".") + ". Keeping your current route."),
+                "etaChangeMinutes": int(eta_penalty),
+                "proposedRouteName": proposed,
+                "reasons": sorted(set(reasons)),
+            }
 
     # ---------- Build reasons & tags ----------
     crime_cur = current_crime["total"]
     crime_can = candidate_crime["total"]
     crime_diff = crime_cur - crime_can  # positive => candidate safer
     eta_penalty = eta_change_min
-    hour = int(time.strftime("%H"))
-    is_night = (hour >= 20 or hour <= 5) or bool(getattr(req, "night_test", None))
-    weather_code = int(cur_wx.get("weather_code", 0))
-    bad_weather = weather_code in {61,63,65,80,81,82,95,96,99,45,48}
 
     reasons = set(normalized.get("reasons", []))
     if crime_diff >= 15:
@@ -391,23 +719,17 @@ def recommend(req: RouteRequest):
         reasons.add(f"Higher recent incidents on candidate (+{-crime_diff})")
     if eta_penalty > 0:
         reasons.add(f"Adds about {eta_penalty} min")
-    try:
-        cur_light = lighting_score_from_steps(cur_leg.get("steps", []))
-        can_light = lighting_score_from_steps(can_leg.get("steps", []))
-        if is_night and can_light != cur_light:
-            if can_light > cur_light:
-                reasons.add("Better lighting cues on candidate at night")
-            else:
-                reasons.add("Current route appears better lit at night")
-    except Exception:
-        pass
+    if is_night and can_light != cur_light:
+        if can_light > cur_light:
+            reasons.add("Better lighting cues on candidate at night")
+        else:
+            reasons.add("Current route appears better lit at night")
     if bad_weather:
         reasons.add("Weather caution (rain/fog/storms)")
 
     rule_tags = []
     if candidate_crime["total"] >= current_crime["total"] + 10:
         rule_tags.append("override:higher_route_crime")
-    detour_cap = req.max_detour_min if getattr(req, "max_detour_min", None) not in (None, 0) else 6
     if eta_penalty >= detour_cap and int(normalized.get("deltaSafety", 0)) <= 1:
         rule_tags.append("override:large_eta_small_gain")
 
@@ -426,7 +748,7 @@ def recommend(req: RouteRequest):
     }
 
     # ---------- Response ----------
-    return {
+    resp = {
         "request": {"start": req.start, "destination": req.destination},
         "routes": {
             "current_eta_min": round(cur_leg["duration"]["value"]/60.0, 1),
@@ -442,9 +764,11 @@ def recommend(req: RouteRequest):
         "weather": {"description": wx_text, "temp_c": temp_c, "precip_mm": precip},
         "agent_response": normalized,
         "scores": scores,
-        "debug": {
-            "prompt": prompt,
-            # Include probe samples (lat, lon, count) — used for weighted heatmap in UI
-            "route_crime": {"current": current_crime, "candidate": candidate_crime},
-        },
     }
+    if req.include_samples or req.debug:
+        # Probe samples as [lat, lon, count] — used for weighted heatmap in UI
+        resp["route_crime"] = {"current": current_crime, "candidate": candidate_crime}
+    if req.debug:
+        resp["debug"] = {"prompt": prompt}
+    background.add_task(_record_metrics, normalized, scores, prompt)
+    return resp
@@ -1,12 +1,42 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
-from polyline import decode as decode_polyline
-import folium
-from folium.plugins import HeatMap
-from streamlit_folium import st_folium
+from streamlit.components.v1 import html as st_html
 
 st.set_page_config(page_title="AqrayPath", layout="wide")
+
+_URL_RE = re.compile(r"(https?://\S+)")
+
+# Keep-alive pool to the backend, shared by /health and /recommend.
+# cache_resource keeps one instance alive across script reruns.
+@st.cache_resource
+def _backend_session() -> requests.Session:
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, backoff_factor=0.2))
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+_SESSION = _backend_session()
+
+@st.cache_resource
+def _background_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="aqraypath")
+
+_EXECUTOR = _background_executor()
+
+def _warm_backend(base_url: str) -> None:
+    # Best effort: only opens the pooled connection and wakes the backend worker
+    try:
+        _SESSION.get(f"{base_url.rstrip('/')}/health", timeout=5)
+    except requests.RequestException:
+        pass
+
 st.title("AqrayPath")
 st.caption("Safety-first walking-route copilot · SDG-11")
 
@@ -22,9 +52,14 @@ if "base_url" not in st.session_state:
 with st.sidebar:
     st.header("Settings")
     base_url_in = st.text_input("Backend BASE_URL", st.session_state.base_url)
-    m = re.search(r"(https?://[^\s]+)", base_url_in.strip())
+    m = _URL_RE.search(base_url_in.strip())
     st.session_state.base_url = m.group(1) if m else base_url_in.strip()
 
+    # Warm DNS/TCP + backend once per URL, hidden behind the user's typing time
+    if st.session_state.get("warmed_url") != st.session_state.base_url:
+        st.session_state.warmed_url = st.session_state.base_url
+        _EXECUTOR.submit(_warm_backend, st.session_state.base_url)
+
     max_detour = st.number_input("Max detour (minutes)", min_value=1, max_value=20, value=6, step=1)
     night_test = st.toggle("Force night mode (demo)", value=False)
 
@@ -33,8 +68,8 @@ with st.sidebar:
 
     if st.button("Check backend"):
         try:
-            r = requests.get(f"{st.session_state.base_url.rstrip('/')}/health", timeout=10)
-            st.success(f"Backend OK: {r.json()}")
+            r = _SESSION.get(f"{st.session_state.base_url.rstrip('/')}/health", timeout=10)
+            st.success(f"Backend OK: {orjson.loads(r.content)}")
         except Exception as e:
             st.error(f"Backend not reachable: {e}")
 
@@ -50,75 +85,60 @@ col_btn, col_status = st.columns([1, 2])
 run_clicked = col_btn.button("Recommend safest route", type="primary")
 
 # ---------- helpers ----------
-def call_backend():
-    url = f"{st.session_state.base_url.rstrip('/')}/recommend"
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_recommendation(base_url: str, start: str, dest: str, night_test: bool, max_detour: int) -> dict:
+    url = f"{base_url.rstrip('/')}/recommend"
     payload = {
         "start": start,
         "destination": dest,
-        "night_test": bool(night_test),
-        "max_detour_min": int(max_detour),
+        "night_test": night_test,
+        "max_detour_min": max_detour,
+        "include_samples": True,  # heatmap needs route_crime samples, not the debug prompt
     }
-    r = requests.post(url, json=payload, timeout=60)
+    r = _SESSION.post(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}, timeout=60)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
-def verdict_html(agent, scores, routes):
-    decision = (agent.get("decision") or "").lower()
-    cur_name = routes.get("current_summary") or "Current route"
-    alt_name = routes.get("candidate_summary") or "Alternative route"
-    cur = scores.get("crime_current")
-    alt = scores.get("crime_candidate")
-    eta = scores.get("eta_change_min")
+def call_backend():
+    return _fetch_recommendation(st.session_state.base_url, start, dest, bool(night_test), int(max_detour))
+
+_BADGE_TPL = "<span style='background:{bg};padding:2px 6px;border-radius:6px;'>{txt}</span>"
+_VERDICT_TPL = "<div style='font-size:1.05rem'>{body}</div>"
 
+# Result helpers take hashable scalars so unrelated reruns reuse the rendered strings
+@st.cache_data(max_entries=32, show_spinner=False)
+def verdict_html(decision, cur_name, alt_name, cur, alt, eta, message):
     time_badge = ""
     time_plain = ""
+    time_dir = ""
     if isinstance(eta, (int, float)):
         if eta > 0:
-            time_badge = f"<span style='background:#fff0cc;padding:2px 6px;border-radius:6px;'>+{int(eta)} min</span>"
-            time_plain = f"+{int(eta)} min longer"
+            time_badge = _BADGE_TPL.format(bg="#fff0cc", txt=f"+{int(eta)} min")
+            time_plain, time_dir = f"+{int(eta)} min longer", "longer"
         elif eta < 0:
-            time_badge = f"<span style='background:#e7ffe7;padding:2px 6px;border-radius:6px;'>-{abs(int(eta))} min</span>"
-            time_plain = f"{abs(int(eta))} min shorter"
+            time_badge = _BADGE_TPL.format(bg="#e7ffe7", txt=f"-{abs(int(eta))} min")
+            time_plain, time_dir = f"{abs(int(eta))} min shorter", "shorter"
 
     inc_badge = ""
     inc_plain = ""
     if isinstance(cur, (int, float)) and isinstance(alt, (int, float)):
-        worse_alt = alt > cur
-        color = "#ffe3e3" if worse_alt else "#e7ffe7"
-        inc_badge = (
-            f"<span style='background:{color};padding:2px 6px;border-radius:6px;'>"
-            f"{int(alt)} vs {int(cur)} incidents</span>"
-        )
         inc_plain = f"{int(alt)} vs {int(cur)} incidents"
+        inc_badge = _BADGE_TPL.format(bg="#ffe3e3" if alt > cur else "#e7ffe7", txt=inc_plain)
 
     if decision == "continue":
-        html = (
-            f"<div style='font-size:1.05rem'>"
-            f"<b>🛡️ Keep current:</b> <b>{cur_name}</b> — alternative shows {inc_badge}"
-            f"{' and is ' + time_badge + ' longer' if time_badge and eta>0 else (' and is ' + time_badge + ' shorter' if time_badge and eta<0 else '')}."
-            f"</div>"
-        )
+        body = (f"<b>🛡️ Keep current:</b> <b>{cur_name}</b> — alternative shows {inc_badge}"
+                + (f" and is {time_badge} {time_dir}" if time_badge else "") + ".")
         summary = f"Keep current: {cur_name} — alternative shows {inc_plain}" + (f" and is {time_plain}." if time_plain else ".")
-        return html, summary
-
-    if decision == "ask_user":
-        html = (
-            f"<div style='font-size:1.05rem'>"
-            f"<b>🧭 Consider alternative:</b> <b>{alt_name}</b> — {inc_badge}"
-            f"{' and ' + time_badge + ' detour' if time_badge else ''}. Reroute now or continue?"
-            f"</div>"
-        )
+    elif decision == "ask_user":
+        body = (f"<b>🧭 Consider alternative:</b> <b>{alt_name}</b> — {inc_badge}"
+                + (f" and {time_badge} detour" if time_badge else "") + ". Reroute now or continue?")
         summary = f"Consider alternative: {alt_name} — {inc_plain}" + (f" and {time_plain} detour." if time_plain else ".")
-        return html, summary
-
-    html = f"<div style='font-size:1.05rem'>{agent.get('message','')}</div>"
-    summary = agent.get("message", "")
-    return html, summary
+    else:
+        body = summary = message
+    return _VERDICT_TPL.format_map({"body": body}), summary
 
-def one_sentence_why(agent, scores):
-    cur = scores.get("crime_current")
-    alt = scores.get("crime_candidate")
-    eta = scores.get("eta_change_min")
+@st.cache_data(max_entries=32, show_spinner=False)
+def one_sentence_why(cur, alt, eta, reasons: tuple):
     parts = []
     if isinstance(cur, (int, float)) and isinstance(alt, (int, float)):
         parts.append(f"alternative shows **{int(alt)} vs {int(cur)} crime incidents**")
@@ -128,12 +148,12 @@ def one_sentence_why(agent, scores):
         else:
             parts.append(f"and is **{abs(int(eta))} min** shorter")
     if not parts:
-        rs = agent.get("reasons") or []
-        return "Why: " + (rs[0].rstrip(".") if rs else "safety and travel time trade-offs considered.") + "."
+        return "Why: " + (reasons[0].rstrip(".") if reasons else "safety and travel time trade-offs considered.") + "."
     return "Why: " + " ".join(parts) + "."
 
-def lighting_tags(agent_reasons):
-    reasons = " ".join(agent_reasons or []).lower()
+@st.cache_data(max_entries=32, show_spinner=False)
+def lighting_tags(agent_reasons: tuple):
+    reasons = " ".join(agent_reasons).lower()
     better_alt = False
     better_cur = False
     if ("better lighting" in reasons or "better lighting cues" in reasons) and ("candidate" in reasons or "alternative" in reasons):
@@ -142,24 +162,102 @@ def lighting_tags(agent_reasons):
         better_cur = True
     return better_cur, better_alt
 
+@st.cache_data(max_entries=32, show_spinner=False)
+def _decode_cached(points: str) -> tuple:
+    from polyline import decode as decode_polyline
+    return tuple(decode_polyline(points))
+
+def _safe_decode(points):
+    try:
+        return list(_decode_cached(points)) if points else []
+    except Exception:
+        return []
+
+# Rendered map HTML is memoized on hashable inputs so unrelated reruns skip folium entirely
+@st.cache_data(max_entries=8, show_spinner=False)
+def _build_map_html(cur_poly: str, alt_poly: str, start_ll: tuple, dest_ll: tuple, highlight_alt: bool,
+                    heat_points: tuple, cur_name: str, alt_name: str) -> str:
+    # Map libs are imported lazily so error/empty reruns don't pay for them
+    import folium
+    from folium.plugins import HeatMap
+
+    center = [
+        float((start_ll[0] or dest_ll[0] or 32.7767)),
+        float((start_ll[1] or dest_ll[1] or -96.7970)),
+    ]
+    m = folium.Map(location=center, zoom_start=14, tiles="OpenStreetMap")
+
+    cur_coords = _thin_coords(_safe_decode(cur_poly))
+    alt_coords = _thin_coords(_safe_decode(alt_poly))
+
+    if cur_coords:
+        folium.PolyLine(
+            cur_coords,
+            weight=6 if not highlight_alt else 3,
+            opacity=0.9 if not highlight_alt else 0.6,
+            tooltip=f"Current: {cur_name}",
+        ).add_to(m)
+
+    if alt_coords:
+        folium.PolyLine(
+            alt_coords,
+            weight=6 if highlight_alt else 3,
+            opacity=0.9 if highlight_alt else 0.6,
+            tooltip=f"Alternative: {alt_name}",
+        ).add_to(m)
+
+    # Markers
+    if start_ll[0] and start_ll[1]:
+        folium.Marker(
+            [float(start_ll[0]), float(start_ll[1])],
+            tooltip="Start",
+            icon=folium.Icon(icon="play", prefix="fa"),
+        ).add_to(m)
+    if dest_ll[0] and dest_ll[1]:
+        folium.Marker(
+            [float(dest_ll[0]), float(dest_ll[1])],
+            tooltip="Destination",
+            icon=folium.Icon(icon="flag", prefix="fa"),
+        ).add_to(m)
+
+    if heat_points:
+        HeatMap(
+            data=[list(p) for p in heat_points],
+            radius=20,     # larger radius for a fuller “density” look
+            blur=15,
+            max_zoom=18,
+            min_opacity=0.3,
+        ).add_to(m)
+    return m.get_root().render()
+
+_MAX_LINE_POINTS = 400  # beyond this, stride-thin polylines before they're embedded in the page
+
+def _thin_coords(coords):
+    if len(coords) <= _MAX_LINE_POINTS:
+        return coords
+    arr = np.asarray(coords, dtype=np.float64)
+    out = arr[::max(1, len(arr) // _MAX_LINE_POINTS)]
+    if not np.array_equal(out[-1], arr[-1]):
+        out = np.vstack([out, arr[-1]])  # always keep the true endpoint
+    # Google polylines carry 5 decimals; rounding keeps the embedded JSON short
+    return np.round(out, 5).tolist()
+
 def route_block(title: str, name: str, incidents: int | None, eta: float | None,
-                is_night: bool, better_lighting_here: bool, weather_desc: str, precip_mm):
-    box = st.container(border=True)
-    with box:
-        st.markdown(f"**{title}: {name}**")
-        bullets = []
-        if isinstance(incidents, (int, float)):
-            bullets.append(f"• **Safety:** {int(incidents)} crime incidents (last 30 days)")
-        else:
-            bullets.append("• **Safety:** no recent incident data")
-        if is_night:
-            bullets.append("• **Lighting:** appears better lit for night" if better_lighting_here else "• **Lighting:** standard or lower lighting")
-        else:
-            bullets.append("• **Lighting:** daylight (night lighting not applied)")
-        if isinstance(eta, (int, float)):
-            bullets.append(f"• **ETA:** ~{eta:.1f} min" if isinstance(eta, float) else f"• **ETA:** ~{eta} min")
-        bullets.append(f"• **Weather:** {weather_desc} · precip {precip_mm} mm")
-        st.write("\n".join(bullets))
+                is_night: bool, better_lighting_here: bool, weather_desc: str, precip_mm) -> str:
+    # One pre-formatted markdown block per route -> a single element per column
+    lines = [f"**{title}: {name}**", ""]
+    if isinstance(incidents, (int, float)):
+        lines.append(f"• **Safety:** {int(incidents)} crime incidents (last 30 days)")
+    else:
+        lines.append("• **Safety:** no recent incident data")
+    if is_night:
+        lines.append("• **Lighting:** appears better lit for night" if better_lighting_here else "• **Lighting:** standard or lower lighting")
+    else:
+        lines.append("• **Lighting:** daylight (night lighting not applied)")
+    if isinstance(eta, (int, float)):
+        lines.append(f"• **ETA:** ~{eta:.1f} min" if isinstance(eta, float) else f"• **ETA:** ~{eta} min")
+    lines.append(f"• **Weather:** {weather_desc} · precip {precip_mm} mm")
+    return "\n".join(lines)
 
 # ---------- call & persist ----------
 if run_clicked:
@@ -183,118 +281,78 @@ elif data:
     agent = data.get("agent_response", {})
     weather = data.get("weather", {})
     scores = data.get("scores", {}) or {}
-    debug = data.get("debug", {})
-
-    st.subheader("Result")
-    html, share_summary = verdict_html(agent, scores, routes)
-    st.markdown(html, unsafe_allow_html=True)
-    st.caption(one_sentence_why(agent, scores))
-
-    if st.button("Copy summary"):
-        st.session_state._copied = share_summary
-    if st.session_state.get("_copied"):
-        st.code(st.session_state._copied, language=None)
 
+    # Pull every field the render needs exactly once
+    decision = (agent.get("decision") or "").lower()
+    reasons = tuple(agent.get("reasons") or ())
     current_name = routes.get("current_summary") or "Current route"
     alt_name = routes.get("candidate_summary") or "Alternative route"
+    cur_poly = routes.get("current_polyline")
+    alt_poly = routes.get("candidate_polyline")
+    start_ll = routes.get("start") or {}
+    dest_ll  = routes.get("destination") or {}
     cur_eta = routes.get("current_eta_min")
     alt_eta = routes.get("candidate_eta_min")
     cur_inc = scores.get("crime_current")
     alt_inc = scores.get("crime_candidate")
+    eta_change = scores.get("eta_change_min")
     is_night = bool(scores.get("is_night"))
-    better_cur, better_alt = lighting_tags(agent.get("reasons", []))
-    wx_desc = f"{weather.get("description","")}"
+    wx_desc = weather.get("description", "")
     precip = weather.get("precip_mm", 0)
 
+    st.subheader("Result")
+    html, share_summary = verdict_html(decision, current_name, alt_name, cur_inc, alt_inc, eta_change,
+                                       agent.get("message", ""))
+    st.markdown(html, unsafe_allow_html=True)
+    st.caption(one_sentence_why(cur_inc, alt_inc, eta_change, reasons))
+
+    if st.button("Copy summary"):
+        st.session_state._copied = share_summary
+    if st.session_state.get("_copied"):
+        st.code(st.session_state._copied, language=None)
+
+    better_cur, better_alt = lighting_tags(reasons)
+
     colA, colB = st.columns(2)
-    with colA:
-        route_block("Current", current_name, cur_inc, cur_eta, is_night, better_cur, wx_desc, precip)
-    with colB:
-        route_block("Alternative", alt_name, alt_inc, alt_eta, is_night, better_alt, wx_desc, precip)
+    colA.container(border=True).markdown(
+        route_block("Current", current_name, cur_inc, cur_eta, is_night, better_cur, wx_desc, precip))
+    colB.container(border=True).markdown(
+        route_block("Alternative", alt_name, alt_inc, alt_eta, is_night, better_alt, wx_desc, precip))
 
     # ----- Map -----
     st.markdown("### Map (recommended route thicker)")
-    cur_poly = routes.get("current_polyline")
-    alt_poly = routes.get("candidate_polyline")
-    start_ll = routes.get("start") or {}
-    dest_ll  = routes.get("destination") or {}
-
-    def _safe_decode(points):
-        try:
-            return decode_polyline(points) if points else []
-        except Exception:
-            return []
-
     if cur_poly and alt_poly:
-        center = [
-            float((start_ll.get("lat") or dest_ll.get("lat") or 32.7767)),
-            float((start_ll.get("lng") or dest_ll.get("lng") or -96.7970)),
-        ]
-        m = folium.Map(location=center, zoom_start=14, tiles="OpenStreetMap")
-
-        cur_coords = _safe_decode(cur_poly)
-        alt_coords = _safe_decode(alt_poly)
-
-        highlight_alt = (agent.get("decision") == "ask_user")
-
-        if cur_coords:
-            folium.PolyLine(
-                cur_coords,
-                weight=6 if not highlight_alt else 3,
-                opacity=0.9 if not highlight_alt else 0.6,
-                tooltip=f"Current: {current_name}",
-            ).add_to(m)
-
-        if alt_coords:
-            folium.PolyLine(
-                alt_coords,
-                weight=6 if highlight_alt else 3,
-                opacity=0.9 if highlight_alt else 0.6,
-                tooltip=f"Alternative: {alt_name}",
-            ).add_to(m)
-
-        # Markers
-        if start_ll.get("lat") and start_ll.get("lng"):
-            folium.Marker(
-                [float(start_ll["lat"]), float(start_ll["lng"])],
-                tooltip="Start",
-                icon=folium.Icon(icon="play", prefix="fa"),
-            ).add_to(m)
-        if dest_ll.get("lat") and dest_ll.get("lng"):
-            folium.Marker(
-                [float(dest_ll["lat"]), float(dest_ll.get("lng"))],
-                tooltip="Destination",
-                icon=folium.Icon(icon="flag", prefix="fa"),
-            ).add_to(m)
-
         # Heatmap (weighted by sample counts from backend)
-        # Uses the probe samples already provided in debug.route_crime.{current,candidate}.samples
+        # Uses the probe samples already provided in route_crime.{current,candidate}.samples
+        heat_points: tuple = ()
         if show_heatmap:
             try:
-                rc = (debug or {}).get("route_crime", {})
-                heat_data: list[list[float]] = []
-
-                for label in ("current", "candidate"):
-                    entry = rc.get(label, {})
-                    for s in entry.get("samples", []):
-                        lat = float(s.get("lat"))
-                        lon = float(s.get("lon"))
-                        count = float(s.get("count", 0))
-                        # Weight the point by its incident count; folium HeatMap supports [lat, lon, weight]
-                        heat_data.append([lat, lon, max(count, 0.0)])
-
-                if heat_data:
-                    HeatMap(
-                        data=heat_data,
-                        radius=20,     # larger radius for a fuller “density” look
-                        blur=15,
-                        max_zoom=18,
-                        min_opacity=0.3,
-                    ).add_to(m)
+                rc = data.get("route_crime") or {}
+                samples = [s for label in ("current", "candidate") for s in rc.get(label, {}).get("samples", [])]
+                if samples:
+                    arr = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+                    # Bin samples into ~10 m cells and sum clipped counts: one weighted point per cell
+                    cells, inv = np.unique(np.round(arr[:, :2], 4), axis=0, return_inverse=True)
+                    w = np.bincount(inv.ravel(), weights=np.maximum(arr[:, 2], 0.0))
+                    keep = w > 0
+                    if keep.any():
+                        # Leaflet.heat only needs relative weights: ship 1..255 ints, not float counts
+                        w = w[keep].astype(np.float32)
+                        q = np.ceil(w / w.max() * 255).astype(np.uint8)
+                        # folium HeatMap supports [lat, lon, weight]
+                        heat_points = tuple(zip(cells[keep, 0].tolist(), cells[keep, 1].tolist(), q.tolist()))
             except Exception as e:
                 st.warning(f"Heatmap unavailable: {e}")
 
-        st_folium(m, width=900, height=540)
+        map_html = _build_map_html(
+            cur_poly, alt_poly,
+            (start_ll.get("lat"), start_ll.get("lng")),
+            (dest_ll.get("lat"), dest_ll.get("lng")),
+            decision == "ask_user",
+            heat_points, current_name, alt_name,
+        )
+        # Nothing reads map state back, so a static embed replaces the st_folium bridge
+        st_html(map_html, height=540, scrolling=False)
     else:
         st.info("No polylines returned. Try again or check backend.")
 